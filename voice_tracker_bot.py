@@ -8,6 +8,8 @@ Environment variables:
   LOG_CHANNEL_ID  (optional) - channel ID for embed logs
   BOT_PREFIX      (optional) - default: "!"
   STAY_CHECK_INTERVAL (optional) - seconds (default: 30)
+  TOTALS_FLUSH_INTERVAL (optional) - seconds between state.json saves for totals (default: 10)
+  LEADERBOARD_CACHE_TTL (optional) - seconds a rendered leaderboard is reused (default: 30)
 
 IMPORTANT:
 - Enable privileged intents in Discord Developer Portal:
@@ -18,28 +20,48 @@ IMPORTANT:
 
 import os
 import json
+import operator
+import signal
 import asyncio
+import atexit
+import heapq
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
 from datetime import datetime, timezone
 from pathlib import Path
 import traceback
 import discord
 from discord.ext import commands
-from typing import Optional, Dict
+from typing import Optional, Dict, DefaultDict, Tuple
+
+try:
+    import orjson  # much faster encoder; stdlib json is the fallback
+except ImportError:
+    orjson = None
 
 # -------------------- Configuration --------------------
 BOT_PREFIX = os.getenv("BOT_PREFIX", "!")
 DATA_DIR = Path(os.getenv("DATA_DIR", "."))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-HISTORY_FILE = DATA_DIR / "voice_history.json"
-TOTALS_FILE = DATA_DIR / "user_totals.json"
-STAY_FILE = DATA_DIR / "persistent_stays.json"
+HISTORY_FILE = DATA_DIR / "voice_history.json"    # legacy, migrated into HISTORY_LOG
+HISTORY_LOG = DATA_DIR / "voice_history.log"
+HISTORY_LOG_ROTATED = DATA_DIR / "voice_history.log.1"
+STATE_FILE = DATA_DIR / "state.json"             # {"totals": {...}, "stays": {...}}
+TOTALS_FILE = DATA_DIR / "user_totals.json"       # legacy, read only if STATE_FILE is missing
+STAY_FILE = DATA_DIR / "persistent_stays.json"    # legacy, read only if STATE_FILE is missing
 
 LOG_CHANNEL_ID = os.getenv("LOG_CHANNEL_ID")
 LOG_CHANNEL_ID = int(LOG_CHANNEL_ID) if LOG_CHANNEL_ID and LOG_CHANNEL_ID.isdigit() else None
 
 STAY_CHECK_INTERVAL = int(os.getenv("STAY_CHECK_INTERVAL", "30"))
+TOTALS_FLUSH_INTERVAL = int(os.getenv("TOTALS_FLUSH_INTERVAL", "10"))
+LEADERBOARD_CACHE_TTL = int(os.getenv("LEADERBOARD_CACHE_TTL", "30"))
 MAX_HISTORY = int(os.getenv("MAX_HISTORY", "2000"))
+HISTORY_LOG_MAX_BYTES = 10 * 1024 * 1024         # rotate voice_history.log to .1 past this size
+EMBED_QUEUE_SIZE = 1024                          # pending embed logs; newer ones are dropped past this
 
 # -------------------- Intents --------------------
 intents = discord.Intents.default()
@@ -52,18 +74,27 @@ intents.message_content = True    # privileged: enable in Developer Portal
 bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents)
 
 # -------------------- Data structures --------------------
-_file_lock = asyncio.Lock()
-voice_history: list = []                       # human-readable lines
-user_totals: Dict[str, int] = {}               # {str(user_id): total_seconds}
-user_sessions: Dict[int, float] = {}           # {user_id: start_timestamp}
+_file_locks: DefaultDict[Path, asyncio.Lock] = defaultdict(asyncio.Lock)  # one per target file
+_history_lock = threading.Lock()               # guards the append handle across worker threads
+_history_append_lock = asyncio.Lock()          # FIFO: keeps log order equal to event order
+_history_fh = None                             # long-lived append handle for HISTORY_LOG
+voice_history: deque = deque(maxlen=MAX_HISTORY)  # human-readable lines
+user_totals: DefaultDict[int, int] = defaultdict(int)  # {user_id: total_seconds}; keys become strings on disk
+user_sessions: Dict[int, float] = {}           # {user_id: time.monotonic() at session start}
 persistent_stays: Dict[int, int] = {}          # {guild_id: channel_id}
+_totals_dirty = False                          # user_totals changed since the last save
+_started = False                               # on_ready also fires on every reconnect
+_lb_cache: Dict[Tuple[int, int], Tuple[float, str]] = {}  # {(guild_id, top): (monotonic, message)}
+_log_channel_cache: Optional[discord.abc.Messageable] = None  # resolved LOG_CHANNEL_ID
+embed_queue: asyncio.Queue = asyncio.Queue(maxsize=EMBED_QUEUE_SIZE)  # (member, action, color, desc, when)
 
 # -------------------- Helpers --------------------
 def now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
-def ts() -> str:
-    return now_utc().strftime("%Y-%m-%d %H:%M:%S UTC")
+def ts(t: Optional[float] = None) -> str:
+    # time.gmtime(None) means "now"; no datetime object on the hot path
+    return time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(t))
 
 def fmt_duration(sec: int) -> str:
     sec = int(sec)
@@ -75,46 +106,147 @@ def fmt_duration(sec: int) -> str:
         return f"{m}m {s}s"
     return f"{s}s"
 
-async def safe_write_json(path: Path, data) -> None:
-    async with _file_lock:
-        tmp = str(path) + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-        os.replace(tmp, str(path))
+def dump_json(data, compact: bool = False) -> bytes:
+    # compact: machine-only files, no indentation and plain ASCII escaping
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS if compact else orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        return orjson.dumps(data, option=option)
+    if compact:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+def load_json(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def write_bytes_atomic(path: Path, data_bytes: bytes) -> None:
+    tmp = str(path) + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data_bytes)
+    os.replace(tmp, str(path))
+
+def write_json_atomic(path: Path, data, compact: bool = False) -> None:
+    write_bytes_atomic(path, dump_json(data, compact))
+
+async def safe_write_json(path: Path, data, compact: bool = False) -> None:
+    # encode on the loop thread so the worker never sees the dict mid-mutation;
+    # the per-path lock only orders the write+replace (FIFO, so snapshots land in order)
+    data_bytes = dump_json(data, compact)
+    async with _file_locks[path]:
+        await asyncio.to_thread(write_bytes_atomic, path, data_bytes)
 
 def safe_read_json(path: Path, default):
     try:
         if path.exists():
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return load_json(f.read())
     except Exception:
         print(f"[WARN] Failed to read {path}; using default.")
     return default
 
+# blocking: run via asyncio.to_thread
+def append_history_line(line: str) -> None:
+    global _history_fh
+    with _history_lock:
+        if _history_fh is None:
+            _history_fh = open(HISTORY_LOG, "a", encoding="utf-8")
+        _history_fh.write(line + "\n")
+        _history_fh.flush()
+        if _history_fh.tell() >= HISTORY_LOG_MAX_BYTES:
+            _history_fh.close()
+            os.replace(str(HISTORY_LOG), str(HISTORY_LOG_ROTATED))
+            _history_fh = open(HISTORY_LOG, "a", encoding="utf-8")
+
+# read back the tail of the history log; migrates the old JSON history on first run
+def load_history() -> deque:
+    if not HISTORY_LOG.exists() and not HISTORY_LOG_ROTATED.exists():
+        legacy = safe_read_json(HISTORY_FILE, [])
+        lines = deque((str(x) for x in legacy), maxlen=MAX_HISTORY) if isinstance(legacy, list) else deque(maxlen=MAX_HISTORY)
+        if lines:
+            with open(HISTORY_LOG, "w", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in lines)
+        return lines
+    # stream the files oldest first: only the last MAX_HISTORY lines are ever held
+    # in memory, and the rotated log backfills a freshly rotated one
+    lines = deque(maxlen=MAX_HISTORY)
+    for path in (HISTORY_LOG_ROTATED, HISTORY_LOG):
+        if not path.exists():
+            continue
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                lines.extend(line.rstrip("\n") for line in f)
+        except Exception:
+            print(f"[WARN] Failed to read {path}; history may be incomplete.")
+    return lines
+
+def load_state():
+    # returns (raw_totals, raw_stays); falls back to the pre-state.json files
+    if STATE_FILE.exists():
+        raw = safe_read_json(STATE_FILE, {})
+        if not isinstance(raw, dict):
+            raw = {}
+        return raw.get("totals", {}), raw.get("stays", {})
+    return safe_read_json(TOTALS_FILE, {}), safe_read_json(STAY_FILE, {})
+
+def state_snapshot() -> dict:
+    # int keys are stringified by the encoder (orjson OPT_NON_STR_KEYS / stdlib json)
+    return {"totals": user_totals, "stays": persistent_stays}
+
 async def persist_all():
-    await asyncio.gather(
-        safe_write_json(HISTORY_FILE, voice_history),
-        safe_write_json(TOTALS_FILE, user_totals),
-        safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()}),
-    )
+    global _totals_dirty
+    # totals ride along with every save; clear first so anything recorded
+    # while the write is in flight marks them dirty again
+    _totals_dirty = False
+    try:
+        await safe_write_json(STATE_FILE, state_snapshot(), compact=True)
+    except Exception:
+        _totals_dirty = True
+        raise
+
+async def flush_totals():
+    if not _totals_dirty:
+        return
+    try:
+        await persist_all()
+    except Exception as e:
+        print("[WARN] totals flush failed:", e)
+
+async def shutdown():
+    # SIGTERM (Heroku, docker stop) skips atexit, so flush before closing the bot
+    await flush_totals()
+    await bot.close()
+
+@atexit.register
+def _persist_at_exit():
+    # the event loop is gone by now, so write synchronously
+    if _totals_dirty:
+        try:
+            write_json_atomic(STATE_FILE, state_snapshot(), compact=True)
+        except Exception as e:
+            print("[WARN] final state flush failed:", e)
 
 async def get_log_channel() -> Optional[discord.TextChannel]:
+    global _log_channel_cache
     if not LOG_CHANNEL_ID:
         return None
+    if _log_channel_cache is not None:
+        return _log_channel_cache
     ch = bot.get_channel(LOG_CHANNEL_ID)
-    if ch:
-        return ch
-    try:
-        return await bot.fetch_channel(LOG_CHANNEL_ID)
-    except Exception:
-        return None
+    if not ch:
+        try:
+            ch = await bot.fetch_channel(LOG_CHANNEL_ID)
+        except Exception:
+            return None
+    _log_channel_cache = ch
+    return ch
 
-async def send_embed_log(member: discord.Member, action: str, color: discord.Color, description: str):
+async def send_embed_log(member: discord.Member, action: str, color: discord.Color, description: str, when: Optional[datetime] = None):
     ch = await get_log_channel()
     if not ch:
         return
     try:
-        embed = discord.Embed(title=f"🎧 Voice Update: {action}", description=description, color=color, timestamp=now_utc())
+        embed = discord.Embed(title=f"🎧 Voice Update: {action}", description=description, color=color, timestamp=when or now_utc())
         embed.set_author(name=member.display_name, icon_url=member.display_avatar.url if member.display_avatar else None)
         embed.set_thumbnail(url=member.display_avatar.url if member.display_avatar else None)
         await ch.send(embed=embed)
@@ -122,20 +254,27 @@ async def send_embed_log(member: discord.Member, action: str, color: discord.Col
         print("[WARN] failed to send embed log:", e)
 
 def record_session_end(user_id: int, start_ts: float, end_ts: float) -> int:
+    global _totals_dirty
     dur = int(end_ts - start_ts)
-    key = str(user_id)
-    user_totals[key] = user_totals.get(key, 0) + dur
+    user_totals[user_id] += dur
+    _totals_dirty = True
+    # stored totals moved, so any cached ranking may be wrong now
+    _lb_cache.clear()
     return dur
 
 # -------------------- Startup --------------------
-@bot.event
-async def on_ready():
+async def load_persisted():
     global voice_history, user_totals, persistent_stays
 
-    # load persisted files
-    voice_history = safe_read_json(HISTORY_FILE, [])
-    user_totals = safe_read_json(TOTALS_FILE, {})
-    raw = safe_read_json(STAY_FILE, {})
+    voice_history = await asyncio.to_thread(load_history)
+    raw_totals, raw = await asyncio.to_thread(load_state)
+    user_totals = defaultdict(int)
+    if isinstance(raw_totals, dict):
+        for k, v in raw_totals.items():
+            try:
+                user_totals[int(k)] = int(v)
+            except (TypeError, ValueError):
+                continue
     if isinstance(raw, dict):
         persistent_stays = {int(k): int(v) for k, v in raw.items()}
     else:
@@ -144,16 +283,46 @@ async def on_ready():
     print(f"✅ Logged in as {bot.user} ({bot.user.id}) - {ts()}")
     print(f"Loaded: {len(voice_history)} history lines, {len(user_totals)} totals, {len(persistent_stays)} stays")
 
-    # Rebuild active sessions from current voice states if we have members intent
+def start_background_tasks():
+    bot.loop.create_task(stay_worker())
+    bot.loop.create_task(totals_flusher())
+    bot.loop.create_task(embed_sender())
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(shutdown()))
+    except NotImplementedError:
+        pass  # no loop signal handlers on Windows; atexit still covers normal exits
+
+@bot.event
+async def on_ready():
+    global _started
+
+    # reconnects fire on_ready again; in-memory state is newer than the files by then,
+    # so only the first call loads them and starts the background workers
+    if not _started:
+        _started = True
+        await load_persisted()
+        start_background_tasks()
+    else:
+        print(f"🔁 Reconnected as {bot.user} - {ts()}")
+
+    # Rebuild active sessions from current voice states if we have members intent.
+    # Runs on every on_ready: voice events missed while disconnected are not replayed.
     if intents.members:
+        in_voice = set()
         for g in bot.guilds:
-            for vc in g.voice_channels:
+            # stage channels emit voice states too; seed and prune from the same set
+            for vc in itertools.chain(g.voice_channels, g.stage_channels):
                 for m in vc.members:
-                    if not m.bot and m.id not in user_sessions:
-                        user_sessions[m.id] = datetime.now(timezone.utc).timestamp()
-
-    # Start the stay background worker
-    bot.loop.create_task(stay_worker())
+                    if not m.bot:
+                        in_voice.add(m.id)
+                        if m.id not in user_sessions:
+                            user_sessions[m.id] = time.monotonic()
+        # left during the outage: the real leave time is unknown, so drop the session
+        for uid in list(user_sessions):
+            if uid not in in_voice:
+                user_sessions.pop(uid, None)
+        _lb_cache.clear()
 
     # announce startup to log channel
     ch = await get_log_channel()
@@ -164,63 +333,91 @@ async def on_ready():
             pass
 
 # -------------------- Voice state handling --------------------
+# Each handler returns (action, color, embed description, log text) or None when
+# there is nothing to log.
+VoiceEvent = Optional[Tuple[str, discord.Color, str, str]]
+
+def _on_noop(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState, now_ts: float) -> VoiceEvent:
+    return None
+
+def _on_join(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState, now_ts: float) -> VoiceEvent:
+    user_sessions[member.id] = now_ts
+    # a new live session changes markers and live seconds in any cached ranking
+    _lb_cache.clear()
+    desc = f"🔊 **{member.mention}** joined **{after.channel.name}**"
+    return "Joined", discord.Color.green(), desc, f"JOIN {member.display_name} -> {after.channel.name}"
+
+def _on_leave(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState, now_ts: float) -> VoiceEvent:
+    start = user_sessions.pop(member.id, None)
+    dur_text = ""
+    if start:
+        dur = record_session_end(member.id, start, now_ts)
+        dur_text = f" (Stayed: {fmt_duration(dur)})"
+    desc = f"❌ **{member.mention}** left **{before.channel.name}**{dur_text}"
+    return "Left", discord.Color.red(), desc, f"LEAVE {member.display_name} <- {before.channel.name}{dur_text}"
+
+def _on_move_or_stay(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState, now_ts: float) -> VoiceEvent:
+    # same channel: mute/deafen/stream toggles, nothing to track
+    if before.channel.id == after.channel.id:
+        return None
+    start = user_sessions.get(member.id)
+    dur_text = ""
+    if start:
+        dur = record_session_end(member.id, start, now_ts)
+        dur_text = f" (Stayed in {before.channel.name}: {fmt_duration(dur)})"
+    else:
+        _lb_cache.clear()  # untracked user becomes live
+    user_sessions[member.id] = now_ts
+    desc = f"➡️ **{member.mention}** moved from **{before.channel.name}** → **{after.channel.name}**{dur_text}"
+    return "Moved", discord.Color.orange(), desc, f"MOVE {member.display_name}: {before.channel.name} -> {after.channel.name}{dur_text}"
+
+# indexed by (before.channel is not None) * 2 + (after.channel is not None)
+VOICE_HANDLERS = (_on_noop, _on_join, _on_leave, _on_move_or_stay)
+
 @bot.event
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
     # ignore bots
     if member.bot:
         return
+    # mute/deafen/video/stream toggles keep the same channel object: bail out before any work
+    if before.channel is after.channel:
+        return
 
-    now_ts = datetime.now(timezone.utc).timestamp()
-    action = None
-    desc = ""
-    color = discord.Color.blue()
-    log_line = None
-
-    # joined
-    if before.channel is None and after.channel is not None:
-        user_sessions[member.id] = now_ts
-        action = "Joined"
-        desc = f"🔊 **{member.mention}** joined **{after.channel.name}**"
-        color = discord.Color.green()
-        log_line = f"[{ts()}] JOIN {member.display_name} -> {after.channel.name}"
-
-    # left
-    elif before.channel is not None and after.channel is None:
-        start = user_sessions.pop(member.id, None)
-        dur_text = ""
-        if start:
-            dur = record_session_end(member.id, start, now_ts)
-            dur_text = f" (Stayed: {fmt_duration(dur)})"
-        action = "Left"
-        desc = f"❌ **{member.mention}** left **{before.channel.name}**{dur_text}"
-        color = discord.Color.red()
-        log_line = f"[{ts()}] LEAVE {member.display_name} <- {before.channel.name}{dur_text}"
-
-    # moved channel
-    elif before.channel is not None and after.channel is not None and before.channel.id != after.channel.id:
-        start = user_sessions.get(member.id)
-        dur_text = ""
-        if start:
-            dur = record_session_end(member.id, start, now_ts)
-            dur_text = f" (Stayed in {before.channel.name}: {fmt_duration(dur)})"
-        user_sessions[member.id] = now_ts
-        action = "Moved"
-        desc = f"➡️ **{member.mention}** moved from **{before.channel.name}** → **{after.channel.name}**{dur_text}"
-        color = discord.Color.orange()
-        log_line = f"[{ts()}] MOVE {member.display_name}: {before.channel.name} -> {after.channel.name}{dur_text}"
-
-    # if we made a log event, persist + send to log channel
-    if log_line:
-        voice_history.append(log_line)
-        # trim
-        if len(voice_history) > MAX_HISTORY:
-            voice_history[:] = voice_history[-MAX_HISTORY:]
-        try:
-            await persist_all()
-        except Exception as e:
-            print("[WARN] persist failed:", e)
-        print(log_line)
-        await send_embed_log(member, action or "Voice", color, desc)
+    # monotonic clock for durations; wall-clock time is only used for the log line
+    now_ts = time.monotonic()
+    state = (before.channel is not None) * 2 + (after.channel is not None)
+    event = VOICE_HANDLERS[state](member, before, after, now_ts)
+    if event is None:
+        return
+    action, color, desc, text = event
+
+    # persist + send to log channel
+    log_line = f"[{ts()}] {text}"
+    voice_history.append(log_line)
+    try:
+        # no await between the deque append and acquiring the lock, so appends
+        # reach the file in the same order as the in-memory history
+        async with _history_append_lock:
+            await asyncio.to_thread(append_history_line, log_line)
+    except Exception as e:
+        print("[WARN] persist failed:", e)
+    print(log_line)
+    # the HTTP send happens in embed_sender so it never holds up the next event
+    try:
+        # stamp the event time now; the send itself may lag behind rate limits
+        embed_queue.put_nowait((member, action, color, desc, now_utc()))
+    except asyncio.QueueFull:
+        print("[WARN] embed queue full; dropping log embed.")
+
+@bot.event
+async def on_disconnect():
+    await flush_totals()
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    global _log_channel_cache
+    if channel.id == LOG_CHANNEL_ID:
+        _log_channel_cache = None
 
 # -------------------- Commands --------------------
 @bot.event
@@ -239,7 +436,8 @@ async def vchistory_cmd(ctx: commands.Context, limit: int = 10):
     limit = max(1, min(limit, 50))
     if not voice_history:
         return await ctx.send("No voice history yet.")
-    logs = "\n".join(voice_history[-limit:])
+    # walk only the last `limit` entries rather than copying the whole deque
+    logs = "\n".join(itertools.islice(voice_history, max(0, len(voice_history) - limit), None))
     # send as code block if long
     if len(logs) > 1800:
         await ctx.send(f"```{logs[:1900]}```")
@@ -249,46 +447,45 @@ async def vchistory_cmd(ctx: commands.Context, limit: int = 10):
 @bot.command(name="vcstats")
 async def vcstats_cmd(ctx: commands.Context, member: Optional[discord.Member] = None):
     member = member or ctx.author
-    total = int(user_totals.get(str(member.id), 0))
-    if member.id in user_sessions:
-        total += int(datetime.now(timezone.utc).timestamp() - user_sessions[member.id])
+    total = user_totals.get(member.id, 0)  # .get so lookups don't insert zero entries
+    start = user_sessions.get(member.id)
+    if start is not None:
+        total += int(time.monotonic() - start)
     await ctx.send(f"**{member.display_name}** total VC time: **{fmt_duration(total)}**")
 
 @bot.command(name="vcleaderboard", aliases=["vcleaders", "vctop"])
 async def vcleaderboard_cmd(ctx: commands.Context, top: int = 10):
     top = max(1, min(top, 25))
-    combined: Dict[int, int] = {}
-    # start with stored totals
-    for uid_str, secs in user_totals.items():
-        try:
-            uid = int(uid_str)
-        except:
-            continue
-        combined[uid] = int(secs)
-    # add live sessions
-    for uid, start_ts in user_sessions.items():
-        combined[uid] = combined.get(uid, 0) + int(datetime.now(timezone.utc).timestamp() - start_ts)
+    cache_key = (ctx.guild.id if ctx.guild else 0, top)
+    cached = _lb_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < LEADERBOARD_CACHE_TTL:
+        return await ctx.send(cached[1])
+    # stored totals, plus live sessions only when someone is actually in voice
+    combined: Dict[int, int] = user_totals
+    if user_sessions:
+        combined = dict(user_totals)
+        now_ts = time.monotonic()
+        for uid, start_ts in user_sessions.items():
+            combined[uid] = combined.get(uid, 0) + int(now_ts - start_ts)
     if not combined:
         return await ctx.send("No voice time recorded yet.")
-    items = sorted(combined.items(), key=lambda x: x[1], reverse=True)[:top]
+    # top-N selection: O(U log N) instead of sorting every user
+    items = heapq.nlargest(top, combined.items(), key=operator.itemgetter(1))
+    live_ids = user_sessions.keys()
+    # bind the cache lookups once; Member and User both expose display_name
+    get_member = ctx.guild.get_member if ctx.guild else (lambda _uid: None)
+    get_user = bot.get_user
     lines = []
     rank = 1
     for uid, secs in items:
-        user = None
-        display = str(uid)
-        try:
-            if ctx.guild:
-                user = ctx.guild.get_member(uid)
-            if not user:
-                user = bot.get_user(uid)
-            if user:
-                display = user.display_name if isinstance(user, discord.Member) else f"{user.name}#{user.discriminator}"
-        except Exception:
-            pass
-        live_marker = " 🔴" if uid in user_sessions else ""
+        user = get_member(uid) or get_user(uid)
+        display = user.display_name if user else str(uid)
+        live_marker = " 🔴" if uid in live_ids else ""
         lines.append(f"#{rank} • **{display}** — {fmt_duration(secs)}{live_marker}")
         rank += 1
-    await ctx.send("\n".join(lines))
+    message = "\n".join(lines)
+    _lb_cache[cache_key] = (time.monotonic(), message)
+    await ctx.send(message)
 
 @bot.command(name="forcejoin")
 @commands.has_permissions(manage_guild=True)
@@ -319,7 +516,7 @@ async def stayvc_cmd(ctx: commands.Context):
     channel = ctx.author.voice.channel
     persistent_stays[ctx.guild.id] = channel.id
     try:
-        await safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()})
+        await persist_all()
     except Exception:
         pass
     # try immediate join
@@ -340,7 +537,7 @@ async def stayvc_cmd(ctx: commands.Context):
 async def setstayvc_cmd(ctx: commands.Context, channel: discord.VoiceChannel):
     persistent_stays[ctx.guild.id] = channel.id
     try:
-        await safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()})
+        await persist_all()
     except Exception:
         pass
     # try immediate join
@@ -361,7 +558,7 @@ async def setstayvc_cmd(ctx: commands.Context, channel: discord.VoiceChannel):
 async def unstayvc_cmd(ctx: commands.Context):
     persistent_stays.pop(ctx.guild.id, None)
     try:
-        await safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()})
+        await persist_all()
     except Exception:
         pass
     vc = discord.utils.get(bot.voice_clients, guild=ctx.guild)
@@ -389,16 +586,15 @@ async def stay_worker():
     print("Stay worker running.")
     while True:
         try:
+            dead = []  # stays whose guild/channel vanished; dropped and saved once per tick
             for guild_id, channel_id in list(persistent_stays.items()):
                 guild = bot.get_guild(guild_id)
                 if not guild:
-                    persistent_stays.pop(guild_id, None)
-                    await safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()})
+                    dead.append(guild_id)
                     continue
                 channel = guild.get_channel(channel_id)
                 if not channel:
-                    persistent_stays.pop(guild_id, None)
-                    await safe_write_json(STAY_FILE, {str(k): v for k, v in persistent_stays.items()})
+                    dead.append(guild_id)
                     continue
                 vc = discord.utils.get(bot.voice_clients, guild=guild)
                 if vc and vc.is_connected() and vc.channel.id == channel_id:
@@ -412,12 +608,35 @@ async def stay_worker():
                     print(f"[WARN] Forbidden to connect to channel {channel.name} ({channel.id}) in guild {guild.name}")
                 except Exception as e:
                     print("[WARN] stay connect failed:", e)
+            if dead:
+                for guild_id in dead:
+                    persistent_stays.pop(guild_id, None)
+                await persist_all()
             await asyncio.sleep(STAY_CHECK_INTERVAL)
         except Exception as e:
             print("[ERROR] stay_worker crashed:", e)
             traceback.print_exc()
             await asyncio.sleep(10)
 
+# -------------------- Background totals flusher --------------------
+async def totals_flusher():
+    await bot.wait_until_ready()
+    while True:
+        await asyncio.sleep(TOTALS_FLUSH_INTERVAL)
+        await flush_totals()
+
+# -------------------- Background embed sender --------------------
+async def embed_sender():
+    await bot.wait_until_ready()
+    while True:
+        args = await embed_queue.get()
+        try:
+            await send_embed_log(*args)
+        except Exception as e:
+            print("[WARN] embed sender failed:", e)
+        finally:
+            embed_queue.task_done()
+
 # -------------------- Run --------------------
 if __name__ == "__main__":
     token = os.getenv("DISCORD_TOKEN")